@@ -7,16 +7,26 @@ Handles translation and bidirectional messaging
 import asyncio
 import json
 import re
-from typing import Optional
+import time
+from collections import OrderedDict
+from typing import Callable, Optional
 from sdf_com_bridge import COMBridge, FeishuCOMBridge, COMMessage, MessageType
 
 
+# Message prefixes for Feishu display
+_EMOJI_PUB = '💬 '
+_EMOJI_PRIV = '💌 '
+
+
 class TranslationService:
     """Translation service - integrate with your preferred API"""
     
-    def __init__(self):
-        # Cache for common translations
-        self.cache = {}
+    def __init__(self, cache_size: int = 10000, cache_ttl: float = 86400):
+        # LRU cache for common translations:
+        # (source_lang, target_lang, text) -> (expires_at, translated)
+        self.cache: OrderedDict = OrderedDict()
+        self.cache_size = cache_size
+        self.cache_ttl = cache_ttl
     
     async def translate(self, text: str, source_lang: str, target_lang: str) -> str:
         """
@@ -31,9 +41,14 @@ class TranslationService:
             Translated text
         """
         # Check cache
-        cache_key = f"{text}:{source_lang}:{target_lang}"
-        if cache_key in self.cache:
-            return self.cache[cache_key]
+        cache_key = (source_lang, target_lang, text)
+        entry = self.cache.get(cache_key)
+        if entry is not None:
+            expires_at, translated = entry
+            if expires_at > time.monotonic():
+                self.cache.move_to_end(cache_key)
+                return translated
+            del self.cache[cache_key]
         
         # TODO: Integrate with actual translation API
         # Options:
@@ -53,10 +68,27 @@ class TranslationService:
         else:
             translated = text
         
-        # Cache result
-        self.cache[cache_key] = translated
+        # Cache result, evicting the least recently used entry once full
+        self.cache[cache_key] = (time.monotonic() + self.cache_ttl, translated)
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
         return translated
     
+    def invalidate(self, predicate: Callable[[str], bool]) -> int:
+        """
+        Drop cached translations whose source text matches predicate
+        
+        E.g. invalidate(lambda text: 'SDF' in text) after changing how a
+        glossary term is translated.
+        
+        Returns:
+            Number of entries removed
+        """
+        stale = [key for key in self.cache if predicate(key[2])]
+        for key in stale:
+            del self.cache[key]
+        return len(stale)
+    
     async def _translate_zh_to_en(self, text: str) -> str:
         """Chinese to English - replace with actual API call"""
         # Placeholder - in production, call translation API
@@ -89,6 +121,24 @@ class FeishuCOMBot:
         # Message callbacks
         self.send_to_feishu: Optional[callable] = None
         
+        # Command dispatch: exact commands, then two-character prefixes
+        self._cmd_table = {
+            'w': self._do_raw,
+            'l': self._do_raw,
+            'r': self._do_raw,
+            'h': self._do_raw,
+            'I': self._do_raw,
+            'q': self._do_quit,
+            'help': self._do_help,
+            '帮助': self._do_help,
+            'status': self._do_status,
+            '状态': self._do_status,
+        }
+        self._prefix_table = {
+            't:': self._do_translate,
+            'g:': self._do_goto,
+        }
+        
     def setup(self):
         """Setup the bot"""
         # Setup COM -> Feishu handler
@@ -111,21 +161,19 @@ class FeishuCOMBot:
             msg['content'] = translated
         
         # Format for Feishu
-        formatted = self._format_for_feishu(msg)
+        fmt = self._format_private if msg.get('is_private') else self._format_public
+        formatted = fmt(msg)
         
         # Send to Feishu
         await self.send_to_feishu(formatted)
     
-    def _format_for_feishu(self, msg: dict) -> str:
-        """Format COM message for Feishu display"""
-        room = msg.get('room', 'unknown')
-        sender = msg.get('from', 'unknown')
-        content = msg.get('content', '')
-        
-        if msg.get('is_private'):
-            return f"💌 [私聊] {sender}: {content}"
-        
-        return f"💬 [{room}] {sender}: {content}"
+    def _format_public(self, msg: dict) -> str:
+        """Format COM room message for Feishu display"""
+        return f"{_EMOJI_PUB}[{msg['room']}] {msg['from']}: {msg['content']}"
+    
+    def _format_private(self, msg: dict) -> str:
+        """Format COM private message for Feishu display"""
+        return f"{_EMOJI_PRIV}[私聊] {msg['from']}: {msg['content']}"
     
     async def handle_feishu_message(self, text: str) -> str:
         """
@@ -146,50 +194,56 @@ class FeishuCOMBot:
         if not text:
             return "请输入命令或消息"
         
-        # t: Translate and send
-        if text.startswith('t:'):
-            chinese = text[2:].strip()
-            if not chinese:
-                return "请在 t: 后输入要翻译的中文"
-            
-            # Translate to English
-            english = await self.translator.translate(chinese, 'zh', 'en')
-            
-            # Send to COM
-            await self.bridge.say(english)
-            
-            return f"✅ 已发送翻译: {english}"
+        handler = self._cmd_table.get(text)
+        if handler:
+            return await handler(text)
         
-        # g: Goto room
-        elif text.startswith('g:'):
-            room = text[2:].strip()
-            if not room:
-                return "请在 g: 后输入房间名"
-            
-            await self.bridge.goto(room)
-            return f"✅ 已切换到房间: {room}"
+        handler = self._prefix_table.get(text[:2])
+        if handler:
+            return await handler(text[2:].strip())
         
-        # Direct COM commands
-        elif text in ['w', 'l', 'r', 'h', 'I', 'q']:
-            if text == 'q':
-                await self.bridge.stop()
-                return "👋 已断开连接"
-            
-            await self.bridge.send_raw(text)
-            return f"✅ 已执行命令: {text}"
+        # Raw message
+        await self.bridge.say(text)
+        return f"✅ 已发送: {text}"
+    
+    async def _do_translate(self, chinese: str) -> str:
+        """t: Translate and send"""
+        if not chinese:
+            return "请在 t: 后输入要翻译的中文"
         
-        # Help command
-        elif text in ['help', '帮助']:
-            return self._get_help_text()
+        # Translate to English
+        english = await self.translator.translate(chinese, 'zh', 'en')
         
-        # Status
-        elif text in ['status', '状态']:
-            return f"📍 当前房间: {self.bridge.current_room}\n👤 用户名: {self.username}"
+        # Send to COM
+        await self.bridge.say(english)
         
-        # Raw message
-        else:
-            await self.bridge.say(text)
-            return f"✅ 已发送: {text}"
+        return f"✅ 已发送翻译: {english}"
+    
+    async def _do_goto(self, room: str) -> str:
+        """g: Goto room"""
+        if not room:
+            return "请在 g: 后输入房间名"
+        
+        await self.bridge.goto(room)
+        return f"✅ 已切换到房间: {room}"
+    
+    async def _do_raw(self, command: str) -> str:
+        """Direct COM commands"""
+        await self.bridge.send_raw(command)
+        return f"✅ 已执行命令: {command}"
+    
+    async def _do_quit(self, command: str) -> str:
+        """Quit"""
+        await self.bridge.stop()
+        return "👋 已断开连接"
+    
+    async def _do_help(self, command: str) -> str:
+        """Help command"""
+        return self._get_help_text()
+    
+    async def _do_status(self, command: str) -> str:
+        """Status"""
+        return f"📍 当前房间: {self.bridge.current_room}\n👤 用户名: {self.username}"
     
     def _get_help_text(self) -> str:
         """Get help text"""
@@ -1,20 +1,59 @@
 #!/usr/bin/env python3
 """
 SDF COM Bridge - Real-time bidirectional message bridge between SDF COM and Feishu
-Uses asyncssh for SSH and pyte for terminal emulation
+Uses asyncssh for SSH; output is split into lines directly, with pyte terminal
+emulation available as a fallback
 """
 
 import asyncio
 import asyncssh
+import hashlib
 import pyte
 import re
 import json
 import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from typing import Callable, Optional, List, Dict
 from dataclasses import dataclass, asdict
 from enum import Enum
 
+try:
+    # google-re2: linear-time DFA matching for the line pattern, if installed
+    import re2 as _line_re
+except ImportError:
+    _line_re = re
+
+
+# Regex patterns for parsing COM messages, fused into a single alternation so
+# each line is scanned once. Alternatives are tried in priority order and the
+# matching branch is reported by m.lastgroup.
+_LINE_RE = _line_re.compile('|'.join([
+    # Room header (may appear anywhere in the line) - group 2: room
+    r"(?P<room>.*?\[you are in '(\w+)')",
+    # [username@host] message - groups 4-6
+    r'(?P<chat>\[(\w+)@(\w+)\]\s+(.+))',
+    # username@host DUMPs ... (emote) - groups 8-11
+    r'(?P<emote>(\w+)@(\w+)\s+(DUMPs|appears|disappears|\.+)\s+(.+))',
+    # Private message indicator - groups 13-15
+    r'(?P<private>From\s+(\w+)@(\w+):\s*(.+))',
+    # System messages
+    r'(?P<system>Unlinking|Linking|COM|Lobby|\*\*\*)',
+]))
+
+# Cheap substring checks run before _LINE_RE: a line can only match if it
+# has a room header, a user@host, or starts like a system message
+_ROOM_HEADER_MARK = "[you are in '"
+_SYSTEM_PREFIXES = ('Unlinking', 'Linking', 'COM', 'Lobby', '***')
+
+# Max bytes taken from the SSH channel per read; large enough to drain a
+# whole burst of output in one pass through the parser
+_READ_SIZE = 65536
+
+# ANSI CSI escape sequences (cursor moves, colours, ...)
+_ANSI_RE = re.compile(rb'\x1b\[[0-?]*[ -/]*[@-~]')
+
 
 class MessageType(Enum):
     CHAT = "chat"           # Regular user message
@@ -24,10 +63,10 @@ class MessageType(Enum):
     UNKNOWN = "unknown"
 
 
-@dataclass
+@dataclass(slots=True, frozen=True)
 class COMMessage:
     """Represents a message from COM"""
-    timestamp: str
+    timestamp: float        # UNIX time; formatted as ISO only in to_dict()
     msg_type: MessageType
     username: str
     host: str
@@ -37,7 +76,7 @@ class COMMessage:
     
     def to_dict(self):
         return {
-            "timestamp": self.timestamp,
+            "timestamp": datetime.fromtimestamp(self.timestamp).isoformat(),
             "type": self.msg_type.value,
             "username": self.username,
             "host": self.host,
@@ -47,32 +86,71 @@ class COMMessage:
         }
 
 
+def _message_key(msg: COMMessage) -> int:
+    """64-bit hash of a message's sender and content, used for deduplication"""
+    data = b'\0'.join((
+        msg.username.encode(),
+        msg.host.encode(),
+        msg.content.encode(),
+    ))
+    return int.from_bytes(hashlib.blake2b(data, digest_size=8).digest(), 'little')
+
+
+class _ScrollCountingScreen(pyte.Screen):
+    """pyte Screen that counts how many lines the whole screen has scrolled
+    up (negative: down), so moved lines can be told apart from new ones"""
+    
+    def __init__(self, columns: int, lines: int):
+        super().__init__(columns, lines)
+        self.scrolled = 0
+    
+    def _scrolls_whole_screen(self) -> bool:
+        return self.margins is None or tuple(self.margins) == (0, self.lines - 1)
+    
+    def index(self):
+        if self.cursor.y == self.lines - 1 and self._scrolls_whole_screen():
+            self.scrolled += 1
+        super().index()
+    
+    def reverse_index(self):
+        if self.cursor.y == 0 and self._scrolls_whole_screen():
+            self.scrolled -= 1
+        super().reverse_index()
+
+
 class COMScreenParser:
-    """Parse COM terminal output using pyte"""
+    """Parse COM terminal output, line by line or using pyte"""
     
     def __init__(self, columns: int = 80, lines: int = 24):
-        self.screen = pyte.Screen(columns, lines)
+        self.screen = _ScrollCountingScreen(columns, lines)
         self.stream = pyte.ByteStream(self.screen)
         self.current_room = "lobby"
-        
-        # Regex patterns for parsing COM messages
-        self.patterns = {
-            # [username@host] message
-            'chat': re.compile(r'\[(\w+)@(\w+)\]\s+(.+)'),
-            # username@host DUMPs ... (emote)
-            'emote': re.compile(r'(\w+)@(\w+)\s+(DUMPs|appears|disappears|\.+)\s+(.+)'),
-            # System messages
-            'system': re.compile(r'^(Unlinking|Linking|COM|Lobby|\*\*\*)'),
-            # Private message indicator
-            'private': re.compile(r'From\s+(\w+)@(\w+):\s*(.+)'),
-            # Room header
-            'room_header': re.compile(r"\[you are in '(\w+)'"),
-        }
+        self._line_buffer = bytearray()
+        # Each row's text as of the last get_dirty_display() call
+        self._seen_rows: List[str] = [''] * lines
     
     def feed(self, data: bytes):
         """Feed raw terminal data to the screen"""
         self.stream.feed(data)
     
+    def feed_lines(self, data: bytes) -> str:
+        """Feed raw terminal data and return the lines it completed as text
+        
+        ANSI escape sequences are stripped; a trailing partial line is kept
+        until the rest of it arrives.
+        """
+        self._line_buffer.extend(data)
+        idx = self._line_buffer.rfind(b'\n')
+        if idx < 0:
+            return ''
+        
+        lines = bytes(self._line_buffer[:idx]).split(b'\n')
+        del self._line_buffer[:idx + 1]
+        return '\n'.join(
+            _ANSI_RE.sub(b'', line).decode('utf-8', 'replace')
+            for line in lines
+        )
+    
     def get_display(self) -> str:
         """Get current screen content as text"""
         lines = []
@@ -82,69 +160,93 @@ class COMScreenParser:
                 lines.append(line)
         return '\n'.join(lines)
     
+    def get_dirty_display(self) -> str:
+        """Get only the lines changed since the last call as text
+        
+        A scroll marks every line dirty, so each dirty row is compared with
+        what the last call saw at that position once shifted by the scroll;
+        lines that only moved up are skipped.
+        """
+        screen = self.screen
+        if not screen.dirty:
+            return ''
+        
+        seen = self._seen_rows
+        rows = len(seen)
+        shift = max(-rows, min(screen.scrolled, rows))
+        if shift > 0:
+            seen = seen[shift:] + [''] * shift
+        elif shift < 0:
+            seen = [''] * -shift + seen[:shift]
+        screen.scrolled = 0
+        
+        display = screen.display
+        lines = []
+        for i in sorted(screen.dirty):
+            line = display[i].rstrip()
+            if line and line != seen[i]:
+                lines.append(line)
+            seen[i] = line
+        screen.dirty.clear()
+        self._seen_rows = seen
+        return '\n'.join(lines)
+    
     def parse_messages(self, text: str) -> List[COMMessage]:
         """Parse text into structured messages"""
         messages = []
-        timestamp = datetime.now().isoformat()
+        timestamp = time.time()
         
         for line in text.split('\n'):
             line = line.strip()
             if not line:
                 continue
             
-            # Check for room header
-            room_match = self.patterns['room_header'].search(line)
-            if room_match:
-                self.current_room = room_match.group(1)
+            if ('@' not in line and _ROOM_HEADER_MARK not in line
+                    and not line.startswith(_SYSTEM_PREFIXES)):
+                continue
+            
+            m = _LINE_RE.match(line)
+            kind = m.lastgroup if m else None
+            if kind is None:
+                continue
+            
+            # Room header
+            if kind == 'room':
+                self.current_room = m.group(2)
                 continue
             
-            # Try to match as chat message
-            chat_match = self.patterns['chat'].match(line)
-            if chat_match:
+            if kind == 'chat':
                 msg = COMMessage(
                     timestamp=timestamp,
                     msg_type=MessageType.CHAT,
-                    username=chat_match.group(1),
-                    host=chat_match.group(2),
-                    content=chat_match.group(3).strip(),
+                    username=m.group(4),
+                    host=m.group(5),
+                    content=m.group(6).strip(),
                     room=self.current_room,
                     raw_line=line
                 )
-                messages.append(msg)
-                continue
-            
-            # Try emote
-            emote_match = self.patterns['emote'].match(line)
-            if emote_match:
+            elif kind == 'emote':
                 msg = COMMessage(
                     timestamp=timestamp,
                     msg_type=MessageType.EMOTE,
-                    username=emote_match.group(1),
-                    host=emote_match.group(2),
-                    content=f"{emote_match.group(3)} {emote_match.group(4)}",
+                    username=m.group(8),
+                    host=m.group(9),
+                    content=f"{m.group(10)} {m.group(11)}",
                     room=self.current_room,
                     raw_line=line
                 )
-                messages.append(msg)
-                continue
-            
-            # Try private
-            private_match = self.patterns['private'].match(line)
-            if private_match:
+            elif kind == 'private':
                 msg = COMMessage(
                     timestamp=timestamp,
                     msg_type=MessageType.PRIVATE,
-                    username=private_match.group(1),
-                    host=private_match.group(2),
-                    content=private_match.group(3).strip(),
+                    username=m.group(13),
+                    host=m.group(14),
+                    content=m.group(15).strip(),
                     room=self.current_room,
                     raw_line=line
                 )
-                messages.append(msg)
-                continue
-            
-            # System message
-            if self.patterns['system'].match(line):
+            else:
+                # System message
                 msg = COMMessage(
                     timestamp=timestamp,
                     msg_type=MessageType.SYSTEM,
@@ -154,33 +256,64 @@ class COMScreenParser:
                     room=self.current_room,
                     raw_line=line
                 )
-                messages.append(msg)
-                continue
+            messages.append(msg)
         
         return messages
 
 
+def _handler_property(msg_type: MessageType) -> property:
+    """Event handler attribute that checks iscoroutinefunction once, on assignment"""
+    def fget(self) -> Optional[Callable[[COMMessage], None]]:
+        entry = self._handlers.get(msg_type)
+        return entry[0] if entry else None
+    
+    def fset(self, handler: Optional[Callable[[COMMessage], None]]):
+        if handler is None:
+            self._handlers.pop(msg_type, None)
+        else:
+            self._handlers[msg_type] = (handler, asyncio.iscoroutinefunction(handler))
+    
+    return property(fget, fset)
+
+
 class COMBridge:
     """Bidirectional bridge between SDF COM and external messaging"""
     
-    def __init__(self, username: str, password: str, host: str = "sdf.org"):
+    # Event handlers
+    on_chat_message = _handler_property(MessageType.CHAT)
+    on_system_message = _handler_property(MessageType.SYSTEM)
+    on_private_message = _handler_property(MessageType.PRIVATE)
+    
+    def __init__(self, username: str, password: str, host: str = "sdf.org",
+                 use_pyte: bool = False):
         self.username = username
         self.password = password
         self.host = host
         self.conn = None
         self.process = None
         self.parser = COMScreenParser()
+        # Full terminal emulation is only needed if COM redraws the screen
+        self.use_pyte = use_pyte
+        # Parsing runs off the event loop; one worker keeps parser state serial
+        self._parse_executor = ThreadPoolExecutor(max_workers=1)
         
-        # Event handlers
-        self.on_chat_message: Optional[Callable[[COMMessage], None]] = None
-        self.on_system_message: Optional[Callable[[COMMessage], None]] = None
-        self.on_private_message: Optional[Callable[[COMMessage], None]] = None
+        # Event handlers: message type -> (handler, is coroutine function)
+        self._handlers: Dict[MessageType, tuple] = {}
         
         # State
         self.running = False
+        self._tasks: List[asyncio.Task] = []
         self.current_room = "lobby"
-        self.message_queue = asyncio.Queue()
-        self.command_queue = asyncio.Queue()
+        # Bounded queues: when message handling falls behind, the read loop
+        # drops the oldest queued message so live chat wins over stale;
+        # command producers simply wait for room
+        self.message_queue = asyncio.Queue(maxsize=1000)
+        self.command_queue = asyncio.Queue(maxsize=100)
+        self._stdin_lock = asyncio.Lock()
+        
+        # Deduplication LRU of recently seen messages
+        self._seen: OrderedDict = OrderedDict()
+        self._seen_max = 1000
         
     async def connect(self):
         """Establish SSH connection"""
@@ -200,7 +333,8 @@ class COMBridge:
         self.process = await self.conn.create_process(
             'com',
             term_type='xterm-256color',
-            term_size=(80, 24)
+            term_size=(80, 24),
+            encoding=None
         )
         return self.process
     
@@ -208,168 +342,178 @@ class COMBridge:
         """Main run loop - starts all tasks"""
         self.running = True
         
-        # Start tasks
-        tasks = [
+        # Start tasks - stop() cancels them, so the loops can block directly
+        self._tasks = [
             asyncio.create_task(self._read_loop()),
             asyncio.create_task(self._command_loop()),
             asyncio.create_task(self._process_messages()),
         ]
         
-        await asyncio.gather(*tasks)
+        await asyncio.gather(*self._tasks)
     
     async def _read_loop(self):
         """Continuously read from COM and parse output"""
-        buffer = b""
+        loop = asyncio.get_running_loop()
         
         while self.running:
             try:
                 # Read available data
-                chunk = await asyncio.wait_for(
-                    self.process.stdout.read(4096),
-                    timeout=0.1
-                )
+                chunk = await self.process.stdout.read(_READ_SIZE)
                 
-                if chunk:
-                    buffer += chunk
-                    
-                    # Feed to terminal emulator
-                    self.parser.feed(chunk)
-                    
-                    # Try to parse complete messages
-                    display = self.parser.get_display()
-                    messages = self.parser.parse_messages(display)
-                    
-                    # Queue messages for processing
-                    for msg in messages:
-                        await self.message_queue.put(msg)
+                if not chunk:
+                    # EOF - COM has exited
+                    break
+                
+                messages = await loop.run_in_executor(
+                    self._parse_executor, self._parse_chunk, chunk
+                )
                 
-            except asyncio.TimeoutError:
-                # Process any remaining buffer content
-                if buffer:
-                    display = self.parser.get_display()
-                    messages = self.parser.parse_messages(display)
-                    for msg in messages:
-                        await self.message_queue.put(msg)
-                    buffer = b""
+                # Queue messages for processing
+                for msg in messages:
+                    self._enqueue_message(msg)
                 
             except Exception as e:
                 print(f"Read loop error: {e}")
                 await asyncio.sleep(1)
     
+    def _parse_chunk(self, chunk: bytes) -> List[COMMessage]:
+        """Parse a chunk of COM output (runs in the parse executor)"""
+        if self.use_pyte:
+            # Feed to terminal emulator and take the changed lines
+            self.parser.feed(chunk)
+            display = self.parser.get_dirty_display()
+        else:
+            display = self.parser.feed_lines(chunk)
+        
+        return self.parser.parse_messages(display)
+    
+    def _enqueue_message(self, msg: COMMessage):
+        """Queue a parsed message, dropping the oldest one if the queue is full"""
+        try:
+            self.message_queue.put_nowait(msg)
+        except asyncio.QueueFull:
+            self.message_queue.get_nowait()
+            self.message_queue.put_nowait(msg)
+    
     async def _command_loop(self):
         """Process commands from queue"""
         while self.running:
             try:
-                cmd = await asyncio.wait_for(
-                    self.command_queue.get(),
-                    timeout=0.5
-                )
+                cmd = await self.command_queue.get()
+                
+                # Coalesce everything already queued into one write
+                batch = [cmd]
+                while not self.command_queue.empty():
+                    batch.append(self.command_queue.get_nowait())
                 
-                if cmd['type'] == 'say':
-                    await self._send_message(cmd['content'])
-                elif cmd['type'] == 'goto':
-                    await self._goto_room(cmd['room'])
-                elif cmd['type'] == 'raw':
-                    await self._send_raw(cmd['command'])
+                async with self._stdin_lock:
+                    await self._send_batch(batch)
                     
-            except asyncio.TimeoutError:
-                continue
             except Exception as e:
                 print(f"Command loop error: {e}")
     
     async def _process_messages(self):
         """Process incoming messages and trigger handlers"""
-        seen_messages = set()  # Deduplication
-        
         while self.running:
             try:
-                msg = await asyncio.wait_for(
-                    self.message_queue.get(),
-                    timeout=0.5
-                )
+                msg = await self.message_queue.get()
+                
+                # Nothing to do for types without a handler
+                entry = self._handlers.get(msg.msg_type)
+                if entry is None:
+                    continue
                 
                 # Deduplicate based on content
-                msg_key = f"{msg.username}:{msg.host}:{msg.content}"
-                if msg_key in seen_messages:
+                msg_key = _message_key(msg)
+                if msg_key in self._seen:
+                    self._seen.move_to_end(msg_key)
                     continue
-                seen_messages.add(msg_key)
+                self._seen[msg_key] = None
                 
-                # Keep set size manageable
-                if len(seen_messages) > 1000:
-                    seen_messages.clear()
+                # Evict the oldest entry once over capacity
+                if len(self._seen) > self._seen_max:
+                    self._seen.popitem(last=False)
                 
-                # Trigger appropriate handler
-                if msg.msg_type == MessageType.CHAT and self.on_chat_message:
-                    await self._call_handler(self.on_chat_message, msg)
-                elif msg.msg_type == MessageType.PRIVATE and self.on_private_message:
-                    await self._call_handler(self.on_private_message, msg)
-                elif msg.msg_type == MessageType.SYSTEM and self.on_system_message:
-                    await self._call_handler(self.on_system_message, msg)
+                await self._call_handler(*entry, msg)
                     
-            except asyncio.TimeoutError:
-                continue
             except Exception as e:
                 print(f"Message processing error: {e}")
     
-    async def _call_handler(self, handler, msg):
+    async def _call_handler(self, handler, is_coro: bool, msg):
         """Safely call a handler"""
         try:
-            if asyncio.iscoroutinefunction(handler):
+            if is_coro:
                 await handler(msg)
             else:
                 handler(msg)
         except Exception as e:
             print(f"Handler error: {e}")
     
-    async def _send_message(self, message: str):
-        """Send a chat message"""
-        # Enter input mode (space)
-        self.process.stdin.write(b' ')
+    def _encode_command(self, cmd: dict) -> bytes:
+        """Encode a queued command as the keystrokes COM expects"""
+        if cmd['type'] == 'say':
+            # Space enters input mode
+            return b' ' + cmd['content'].encode() + b'\n'
+        elif cmd['type'] == 'goto':
+            return b'g\n' + cmd['room'].encode() + b'\n'
+        elif cmd['type'] == 'raw':
+            return cmd['command'].encode() + b'\n'
+        return b''
+    
+    async def _send_batch(self, batch: List[dict]):
+        """Send several commands with a single write and drain"""
+        data = b''.join(self._encode_command(cmd) for cmd in batch)
+        self.process.stdin.write(data)
         await self.process.stdin.drain()
-        await asyncio.sleep(0.2)
         
-        # Send message
-        self.process.stdin.write(message.encode() + b'\n')
-        await self.process.stdin.drain()
-        await asyncio.sleep(0.3)
+        # Give COM time to echo; a room change takes a little longer
+        settle = 0.3
+        for cmd in batch:
+            if cmd['type'] == 'goto':
+                self.current_room = cmd['room']
+                settle = 0.5
+        await asyncio.sleep(settle)
+    
+    async def _send_message(self, message: str):
+        """Send a chat message"""
+        await self._send_batch([{'type': 'say', 'content': message}])
     
     async def _goto_room(self, room: str):
         """Switch to a room"""
-        self.process.stdin.write(b'g\n')
-        await self.process.stdin.drain()
-        await asyncio.sleep(0.3)
-        
-        self.process.stdin.write(room.encode() + b'\n')
-        await self.process.stdin.drain()
-        await asyncio.sleep(0.5)
-        
-        self.current_room = room
+        await self._send_batch([{'type': 'goto', 'room': room}])
     
     async def _send_raw(self, command: str):
         """Send raw command"""
-        self.process.stdin.write(command.encode() + b'\n')
-        await self.process.stdin.drain()
-        await asyncio.sleep(0.3)
+        await self._send_batch([{'type': 'raw', 'command': command}])
+    
+    async def _submit(self, cmd: dict):
+        """Send a command directly when stdin is idle, otherwise queue it"""
+        if self._stdin_lock.locked() or not self.command_queue.empty():
+            await self.command_queue.put(cmd)
+            return
+        
+        async with self._stdin_lock:
+            await self._send_batch([cmd])
     
     # Public API for sending commands
     
     async def say(self, message: str):
-        """Queue a message to send"""
-        await self.command_queue.put({
+        """Send or queue a message"""
+        await self._submit({
             'type': 'say',
             'content': message
         })
     
     async def goto(self, room: str):
-        """Queue a room change"""
-        await self.command_queue.put({
+        """Send or queue a room change"""
+        await self._submit({
             'type': 'goto',
             'room': room
         })
     
     async def send_raw(self, command: str):
-        """Queue a raw command"""
-        await self.command_queue.put({
+        """Send or queue a raw command"""
+        await self._submit({
             'type': 'raw',
             'command': command
         })
@@ -377,11 +521,21 @@ class COMBridge:
     async def stop(self):
         """Stop the bridge"""
         self.running = False
+        current = asyncio.current_task()
+        for task in self._tasks:
+            if task is not current:
+                task.cancel()
+        self._tasks = []
+        self._parse_executor.shutdown(wait=False)
         if self.process:
-            await self.send_raw('q')
+            # Command loop is gone, so write the quit directly
+            async with self._stdin_lock:
+                await self._send_raw('q')
             self.process.close()
+            self.process = None
         if self.conn:
             self.conn.close()
+            self.conn = None
 
 
 class FeishuCOMBridge:
@@ -5,134 +5,561 @@ SDF COM Client - SSH connection and COM chat automation for sdf.org
 
 import asyncio
 import asyncssh
+import math
+import os
+import re
+import stat
 import sys
+import tempfile
+import time
 import argparse
+from typing import AsyncIterator, Dict, List, Optional, Pattern, Sequence, Tuple
+
+
+# Assumed command-mode prompt until start_com() has seen COM's real one.
+# Input prompts such as ':goto> ' are deliberately not matched: they show up
+# mid-way through two-step commands. COM normally shows just a cursor in
+# command mode, in which case no prompt is used and a response ends once
+# output goes quiet.
+PROMPT = re.compile(rb'(?:^|\n)>\s*$')
+
+# Patterns marking a complete response, so reading can stop as soon as one
+# is seen rather than waiting for output to go quiet
+# "[you are in 'spacebar' among 12]" after a room change, followed by a blank
+# line, the room's users one per line and another blank line
+ROOM_ENTERED = re.compile(
+    rb"\[you are in '[^']+'[^\]\n]*\]\r?\n\r?\n(?:[^\s@]+@\S+\r?\n)+\r?\n"
+)
+# Room list table: a header rule, the rooms, then a closing rule
+ROOM_LIST_END = re.compile(rb'-{20,}.*\n(?:.*\n)*?\s*-{20,}')
+RESPONSE_END = {'l': ROOM_LIST_END}
+
+# Max output taken per read; enough for a full room listing or history dump
+READ_SIZE = 65536
+
+# Cap on buffered command output; the oldest bytes are dropped beyond this
+RESPONSE_MAX = 1 << 20
+
+# Unsolicited lines kept for messages() before the oldest are dropped
+MESSAGES_MAX = 1000
+
+# How long cached output of read-only commands stays fresh, in seconds. Stale
+# output up to STALE_FACTOR x TTL old is still served while it is refreshed
+# in the background.
+CACHE_TTL = {'h': math.inf, 'l': 10.0, 'I': 30.0, 'w': 2.0}
+STALE_FACTOR = 3
+
+# Preferred SSH algorithms: AES-GCM (hardware accelerated on most CPUs) with a
+# curve25519 key exchange, and no compression since COM traffic is small text
+ENCRYPTION_ALGS = ('aes128-gcm@openssh.com', 'aes256-gcm@openssh.com',
+                   'chacha20-poly1305@openssh.com')
+KEX_ALGS = ('curve25519-sha256', 'curve25519-sha256@libssh.org')
+MAC_ALGS = ('hmac-sha2-256-etm@openssh.com',)
+COMPRESSION_ALGS = ('none',)
+
+# Host keys remembered on first connect (trust on first use) and checked on
+# every later connect
+KNOWN_HOSTS = os.path.expanduser('~/.config/sdf-com/known_hosts')
+
+# SSH connections shared by all clients with the same connection settings
+# (see SDFComClient._conn_key()), and how many clients are using each; COM
+# sessions are opened as cheap channels on an existing connection instead of
+# paying for a new handshake
+_SHARED_CONN: Dict[tuple, asyncssh.SSHClientConnection] = {}
+_SHARED_USERS: Dict[tuple, int] = {}
+
+
+class _ReadTimer:
+    """One timer ending a read at its deadline, or once output has been quiet
+    for idle seconds
+
+    Output arriving only records a timestamp. The timer is pulled in once,
+    when the first output arrives, and otherwise re-armed only when it fires
+    early because more output came in since it was set.
+    """
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, deadline: float,
+                 idle: float, on_expire):
+        self.loop = loop
+        self.deadline = deadline
+        self.idle = idle
+        self.on_expire = on_expire
+        self.last_data: Optional[float] = None
+        self.expired = False
+        # Expired by a pause in output rather than the deadline
+        self.went_idle = False
+        self._handle = loop.call_at(deadline, self._fire)
+
+    def data(self):
+        """Note that output has arrived"""
+        now = self.loop.time()
+        first = self.last_data is None
+        self.last_data = now
+        if first and now + self.idle < self.deadline:
+            self._handle.cancel()
+            self._handle = self.loop.call_at(now + self.idle, self._fire)
+
+    def _fire(self):
+        now = self.loop.time()
+        due = self.deadline
+        if self.last_data is not None:
+            due = min(self.last_data + self.idle, due)
+        if due > now:
+            self._handle = self.loop.call_at(due, self._fire)
+            return
+        self.expired = True
+        self.went_idle = due < self.deadline
+        self.on_expire()
+
+    def cancel(self):
+        self._handle.cancel()
 
 
 class SDFComClient:
     """Client for connecting to SDF.org and operating COM chat"""
 
-    def __init__(self, username: str, password: str, host: str = "sdf.org"):
+    # Precomputed inputs for fixed commands
+    _B_LIST = b'l\n'
+    _B_WHO = b'w\n'
+    _B_HELP = b'h\n'
+    _B_IDLE = b'I\n'
+    _B_REVIEW = b'r\n'
+    _B_QUIT = b'q\n'
+    _B_GOTO = b'g\n'
+    _B_HISTORY = b'R\n'
+    _B_EMOTE = b'e\n'
+    # Cached command -> input
+    _B_CACHED = {'l': _B_LIST, 'w': _B_WHO, 'h': _B_HELP, 'I': _B_IDLE}
+
+    def __init__(self, username: str, password: str, host: str = "sdf.org",
+                 encryption_algs: Optional[Sequence[str]] = ENCRYPTION_ALGS,
+                 kex_algs: Optional[Sequence[str]] = KEX_ALGS,
+                 mac_algs: Optional[Sequence[str]] = MAC_ALGS,
+                 compression_algs: Optional[Sequence[str]] = COMPRESSION_ALGS):
         self.username = username
         self.password = password
         self.host = host
+        # SSH algorithm preferences; None leaves asyncssh's defaults
+        self.ssh_algs = {
+            'encryption_algs': encryption_algs,
+            'kex_algs': kex_algs,
+            'mac_algs': mac_algs,
+            'compression_algs': compression_algs,
+        }
+        self.known_hosts = KNOWN_HOSTS
         self.conn = None
+        # Registry key the connection was opened under
+        self._conn_key_used: Optional[tuple] = None
+        # Set on spawn_com() sessions whose connection belongs to the parent
+        self._borrowed_conn = False
         self.process = None
+        self.prompt: Optional[Pattern[bytes]] = PROMPT
+        self.welcome = ''
+        # Serialises exchanges, including background cache refreshes
+        self._lock = asyncio.Lock()
+        # Command -> (time fetched, output), plus in-flight refreshes
+        self._cache: Dict[str, Tuple[float, str]] = {}
+        self._refreshing: Dict[str, asyncio.Task] = {}
+        # Extra COM sessions opened with spawn_com()
+        self.sessions: List['SDFComClient'] = []
+        # Background reader state: output collected for the current command,
+        # and lines COM printed on its own (other users chatting, ...)
+        self._reader_task: Optional[asyncio.Task] = None
+        self._buf = bytearray()
+        # Bytes trimmed off the front of _buf since it was last cleared
+        self._dropped = 0
+        self._new_data = asyncio.Event()
+        self._collecting = False
+        self._eof = False
+        # Whether the last response ended normally: on the prompt, its end
+        # marker or a pause in output, rather than the deadline or EOF
+        self._complete = False
+        self._pending_line = bytearray()
+        self._messages: asyncio.Queue = asyncio.Queue(maxsize=MESSAGES_MAX)
 
     async def connect(self):
-        """Establish SSH connection to SDF"""
-        self.conn = await asyncssh.connect(
-            self.host,
-            username=self.username,
-            password=self.password,
-            known_hosts=None  # Accept new host keys
-        )
+        """Establish SSH connection to SDF, reusing an open one if possible"""
+        if self.conn is not None and not self.conn.is_closed():
+            return self.conn
+
+        key = self._conn_key()
+        conn = _SHARED_CONN.get(key)
+        if conn is None or conn.is_closed():
+            known = self._host_is_known()
+            conn = await asyncssh.connect(
+                self.host,
+                username=self.username,
+                password=self.password,
+                # Accept a new host's key, then pin it
+                known_hosts=self.known_hosts if known else None,
+                **{k: list(v) for k, v in self.ssh_algs.items() if v is not None}
+            )
+            if not known:
+                self._save_host_key(conn)
+            _SHARED_CONN[key] = conn
+            _SHARED_USERS[key] = 0
+
+        _SHARED_USERS[key] += 1
+        self.conn = conn
+        self._conn_key_used = key
         return self.conn
 
+    def _conn_key(self) -> tuple:
+        """Everything that determines the SSH connection, so clients only
+        share a connection opened with exactly their own settings"""
+        algs = tuple((name, None if algs is None else tuple(algs))
+                     for name, algs in sorted(self.ssh_algs.items()))
+        return (self.host, self.username, self.password, algs,
+                self.known_hosts)
+
+    def _host_is_known(self) -> bool:
+        """Whether the known_hosts file has a key for this host"""
+        try:
+            with open(self.known_hosts) as f:
+                return any(line.split(' ', 1)[0] == self.host for line in f)
+        except FileNotFoundError:
+            return False
+
+    def _save_host_key(self, conn: asyncssh.SSHClientConnection):
+        """Add the server's host key to the known_hosts file
+
+        Does nothing if another client saved a key for this host while this
+        one was connecting. The file is replaced in one step, so concurrent
+        writers never leave duplicate or partial lines.
+        """
+        key = conn.get_server_host_key()
+        if key is None:
+            return
+        if isinstance(key, asyncssh.SSHCertificate):
+            # Pin the key the certificate was issued for
+            key = key.key
+        # Another client may have saved it while this one was connecting
+        if self._host_is_known():
+            return
+
+        line = f"{self.host} {key.export_public_key('openssh').decode().strip()}\n"
+        directory = os.path.dirname(self.known_hosts)
+        os.makedirs(directory, exist_ok=True)
+        try:
+            with open(self.known_hosts) as f:
+                existing = f.read()
+        except FileNotFoundError:
+            existing = ''
+        if existing and not existing.endswith('\n'):
+            existing += '\n'
+        fd, tmp = tempfile.mkstemp(dir=directory)
+        try:
+            with os.fdopen(fd, 'w') as f:
+                f.write(existing + line)
+            os.replace(tmp, self.known_hosts)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+
     async def start_com(self):
-        """Start COM chat program"""
+        """Start COM chat program
+
+        Reads COM's welcome screen into self.welcome and takes the prompt
+        from the end of it.
+        """
         if not self.conn:
             raise RuntimeError("Not connected. Call connect() first.")
 
+        # encoding=None: exchange raw bytes, decoding output once per read
         self.process = await self.conn.create_process(
             'com',
-            term_type='xterm-256color'
+            term_type='xterm-256color',
+            encoding=None
         )
+
+        # COM's welcome screen counts as the response to starting it
+        self._collecting = True
+        self._eof = False
+        self._reader_task = asyncio.create_task(self._reader_loop())
+        async with self._lock:
+            self.welcome = await self._read_output(timeout=3.0)
+        self.prompt = _sample_prompt(self.welcome)
         return self.process
 
+    async def _reader_loop(self):
+        """Continuously drain COM output
+
+        While a command is waiting for its response, output goes to the
+        response buffer; otherwise it is split into lines for messages().
+        """
+        try:
+            while True:
+                chunk = await self.process.stdout.read(READ_SIZE)
+                if not chunk:
+                    break
+                if self._collecting:
+                    self._buf.extend(chunk)
+                    if len(self._buf) > RESPONSE_MAX:
+                        excess = len(self._buf) - RESPONSE_MAX
+                        del self._buf[:excess]
+                        self._dropped += excess
+                else:
+                    self._dispatch_lines(chunk)
+                self._new_data.set()
+        finally:
+            self._eof = True
+            self._new_data.set()
+            self._put_message(None)
+
+    def _dispatch_lines(self, chunk: bytes):
+        """Queue the complete lines in unsolicited output for messages()"""
+        self._pending_line.extend(chunk)
+        idx = self._pending_line.rfind(b'\n')
+        if idx < 0:
+            return
+        lines = bytes(self._pending_line[:idx]).split(b'\n')
+        del self._pending_line[:idx + 1]
+        for line in lines:
+            line = line.rstrip(b'\r')
+            if line:
+                self._put_message(line.decode('utf-8', 'replace'))
+
+    def _put_message(self, line: Optional[str]):
+        """Queue a line, dropping the oldest one if nobody is keeping up"""
+        try:
+            self._messages.put_nowait(line)
+        except asyncio.QueueFull:
+            self._messages.get_nowait()
+            self._messages.put_nowait(line)
+
+    async def messages(self) -> AsyncIterator[str]:
+        """Yield lines COM prints outside of command responses, such as
+        other users' chat, until COM exits"""
+        while True:
+            line = await self._messages.get()
+            if line is None:
+                return
+            yield line
+
+    async def spawn_com(self) -> 'SDFComClient':
+        """Start another, independent COM session on the same SSH connection
+
+        Opening a channel costs one round trip instead of a full handshake.
+        The returned client has the usual command methods and is
+        disconnected along with this one.
+        """
+        if not self.conn:
+            raise RuntimeError("Not connected. Call connect() first.")
+
+        session = SDFComClient(self.username, self.password, self.host,
+                               **self.ssh_algs)
+        # Use this client's connection even if the shared registry has since
+        # moved on to another one
+        key = self._conn_key_used
+        if _SHARED_CONN.get(key) is self.conn:
+            _SHARED_USERS[key] += 1
+            session._conn_key_used = key
+        else:
+            session._borrowed_conn = True
+        session.known_hosts = self.known_hosts
+        session.conn = self.conn
+        await session.start_com()
+        self.sessions.append(session)
+        return session
+
     async def send_command(self, command: str, wait_for_output: bool = True):
         """Send a command to COM and optionally wait for output"""
         if not self.process:
             raise RuntimeError("COM not started. Call start_com() first.")
 
-        self.process.stdin.write(command + '\n')
-        await self.process.stdin.drain()
-
         if wait_for_output:
-            # Give COM time to respond
-            await asyncio.sleep(0.5)
-            output = await self._read_output()
-            return output
+            return await self._exchange(command.encode() + b'\n',
+                                        done=RESPONSE_END.get(command))
+
+        async with self._lock:
+            await self._write(command.encode() + b'\n')
         return None
 
-    async def _read_output(self, timeout: float = 2.0):
-        """Read available output from COM"""
-        output = ""
+    async def _write(self, data: bytes):
+        """Write to COM, waiting on flow control only if data is backed up
+
+        COM commands are tiny and almost never fill the channel window, so
+        an unconditional drain() would just cost an extra event-loop trip.
+        """
+        stdin = self.process.stdin
+        stdin.write(data)
+        if stdin.channel.get_write_buffer_size():
+            await stdin.drain()
+
+    async def _exchange(self, *inputs: bytes, until_prompt: bool = True,
+                        done: Optional[Pattern[bytes]] = None,
+                        timeout: float = 2.0, idle: float = 0.3):
+        """Write inputs to COM and read its response up to the next prompt
+
+        Multi-step commands (e.g. 'g\n' then the room name) are sent as one
+        write: COM reads the queued argument as soon as it asks for it.
+        """
+        if not self.process:
+            raise RuntimeError("COM not started. Call start_com() first.")
+
+        async with self._lock:
+            self._buf.clear()
+            self._dropped = 0
+            # A partial unsolicited line can't be continued by the response
+            self._pending_line.clear()
+            self._collecting = True
+            await self._write(b''.join(inputs))
+            return await self._read_output(timeout=timeout, idle=idle,
+                                           until_prompt=until_prompt, done=done)
+
+    async def pipeline(self, *inputs: bytes,
+                       done: Optional[Pattern[bytes]] = None):
+        """Send several raw COM inputs back-to-back and read their combined
+        output, instead of waiting for each response in turn
+
+        Allows 2 seconds per input. If done is given (the end of the last
+        response), reading stops as soon as it matches, and otherwise rides
+        out pauses in output of up to a second (e.g. a slow room change)
+        instead of 0.3 seconds.
+        """
+        # Each input ends in its own prompt, so read until output goes quiet
+        return await self._exchange(*inputs, until_prompt=False, done=done,
+                                    timeout=2.0 * len(inputs),
+                                    idle=1.0 if done else 0.3)
+
+    async def _cached(self, command: str):
+        """Run a read-only command, serving its output from cache if fresh"""
+        entry = self._cache.get(command)
+        if entry is not None:
+            fetched, output = entry
+            age = time.monotonic() - fetched
+            ttl = CACHE_TTL[command]
+            if age < ttl:
+                return output
+            if age < ttl * STALE_FACTOR:
+                # Stale-while-revalidate
+                if command not in self._refreshing:
+                    task = asyncio.create_task(self._refresh(command))
+                    task.add_done_callback(self._refresh_done)
+                    self._refreshing[command] = task
+                return output
+        return await self._refresh(command)
+
+    def _refresh_done(self, task: asyncio.Task):
+        """Forget a finished background refresh
+
+        A failed refresh (e.g. COM has exited) just leaves the stale entry;
+        its exception is retrieved here so asyncio doesn't log it.
+        """
+        for command, pending in list(self._refreshing.items()):
+            if pending is task:
+                del self._refreshing[command]
+        if not task.cancelled():
+            task.exception()
+
+    async def _refresh(self, command: str):
+        """Run a command and cache its output
+
+        Output cut short by the deadline or COM exiting is returned but not
+        cached.
+        """
+        output = await self._exchange(self._B_CACHED[command],
+                                      done=RESPONSE_END.get(command))
+        if output and self._complete:
+            self._cache[command] = (time.monotonic(), output)
+        return output
+
+    def invalidate(self, command: Optional[str] = None):
+        """Drop cached output for a command, or for all commands"""
+        if command is None:
+            self._cache.clear()
+        else:
+            self._cache.pop(command, None)
+
+    async def _read_output(self, timeout: float = 2.0, idle: float = 0.3,
+                           until_prompt: bool = True,
+                           done: Optional[Pattern[bytes]] = None):
+        """Read output from COM until its prompt appears
+
+        Waits up to timeout seconds for output to start; if no prompt is
+        seen (or COM shows none), stops once output has been quiet for idle
+        seconds. If done is given, reading also stops as soon as it matches
+        the output.
+        """
+        loop = asyncio.get_running_loop()
+        buf = self._buf
+        self._collecting = True
+        # Output position scanned so far, counting bytes trimmed off the front
+        scanned = self._dropped
+        prompt = self.prompt if until_prompt else None
+        self._complete = False
+        # One timer for the whole read, waking this loop when it expires
+        timer = _ReadTimer(loop, loop.time() + timeout, idle,
+                           self._new_data.set)
         try:
             while True:
-                line = await asyncio.wait_for(
-                    self.process.stdout.readline(),
-                    timeout=0.3
-                )
-                if line:
-                    output += line
-                else:
+                # The prompt sits at the very end, so only scan the newly
+                # read bytes (plus the newline that may precede them) rather
+                # than rescanning the whole buffer each time
+                start = max(0, scanned - self._dropped - 2)
+                if prompt is not None and prompt.search(buf, start):
+                    self._complete = True
+                    break
+                if done is not None and done.search(buf):
+                    self._complete = True
+                    break
+                if self._eof:
                     break
-        except asyncio.TimeoutError:
-            pass
+                if timer.expired:
+                    # Output going quiet ends a response normally; only
+                    # running into the deadline means it may be cut short
+                    self._complete = timer.went_idle
+                    break
+                received = self._dropped + len(buf)
+                if received > scanned:
+                    timer.data()
+                scanned = received
+
+                self._new_data.clear()
+                await self._new_data.wait()
+        finally:
+            timer.cancel()
+            self._collecting = False
+
+        output = buf.decode('utf-8', 'replace')
+        buf.clear()
+        self._dropped = 0
         return output
 
     async def get_room_list(self):
         """List all available rooms (l command)"""
-        return await self.send_command('l')
+        return await self._cached('l')
 
     async def get_user_list(self):
         """List users in current room (w command)"""
-        return await self.send_command('w')
+        return await self._cached('w')
 
     async def goto_room(self, room_name: str):
         """Go to a specific room (g command)"""
-        self.process.stdin.write('g\n')
-        await self.process.stdin.drain()
-        await asyncio.sleep(0.3)
-
-        self.process.stdin.write(room_name + '\n')
-        await self.process.stdin.drain()
-        await asyncio.sleep(0.5)
-
-        return await self._read_output()
+        output = await self._exchange(self._B_GOTO, room_name.encode() + b'\n',
+                                      done=ROOM_ENTERED)
+        # Room list counts and the user list change with the current room
+        self.invalidate('l')
+        self.invalidate('w')
+        return output
 
     async def say(self, message: str):
         """Say something in the current room (space + message)"""
         # Space enters input mode
-        self.process.stdin.write(' ')
-        await self.process.stdin.drain()
-        await asyncio.sleep(0.2)
-
-        # Type the message
-        self.process.stdin.write(message + '\n')
-        await self.process.stdin.drain()
-        await asyncio.sleep(0.5)
-
-        return await self._read_output()
+        return await self._exchange(b' ', message.encode() + b'\n')
 
     async def review_history(self, lines: int = 18):
         """Review room history (r or R command)"""
         if lines <= 18:
-            return await self.send_command('r')
+            return await self._exchange(self._B_REVIEW)
         else:
-            self.process.stdin.write('R\n')
-            await self.process.stdin.drain()
-            await asyncio.sleep(0.3)
-
-            self.process.stdin.write(str(lines) + '\n')
-            await self.process.stdin.drain()
-            await asyncio.sleep(0.5)
-
-            return await self._read_output()
+            return await self._exchange(self._B_HISTORY, b'%d\n' % lines)
 
     async def peek_room(self, room_name: str, lines: int = 18):
         """Peek into another room (p command)"""
-        self.process.stdin.write(f'p{room_name}\n')
-        await self.process.stdin.drain()
-        await asyncio.sleep(0.5)
-
         if lines != 18:
-            self.process.stdin.write(str(lines) + '\n')
-            await self.process.stdin.drain()
-            await asyncio.sleep(0.3)
-
-        return await self._read_output()
+            return await self._exchange(b'p' + room_name.encode() + b'\n', b'%d\n' % lines)
+        return await self._exchange(b'p' + room_name.encode() + b'\n')
 
     async def send_private(self, user: str, message: str, room: str = None):
         """Send private message (s command): suser@host [room]"""
@@ -141,64 +568,150 @@ class SDFComClient:
         else:
             cmd = f's{user}'
 
-        self.process.stdin.write(cmd + '\n')
-        await self.process.stdin.drain()
-        await asyncio.sleep(0.3)
-
-        self.process.stdin.write(message + '\n')
-        await self.process.stdin.drain()
-        await asyncio.sleep(0.5)
-
-        return await self._read_output()
+        return await self._exchange(cmd.encode() + b'\n', message.encode() + b'\n')
 
     async def emote(self, action: str):
         """Send emote (e command)"""
-        self.process.stdin.write('e\n')
-        await self.process.stdin.drain()
-        await asyncio.sleep(0.3)
-
-        self.process.stdin.write(action + '\n')
-        await self.process.stdin.drain()
-        await asyncio.sleep(0.5)
-
-        return await self._read_output()
+        return await self._exchange(self._B_EMOTE, action.encode() + b'\n')
 
     async def get_help(self):
         """Show COM help (h command)"""
-        return await self.send_command('h')
+        return await self._cached('h')
 
     async def query_idle(self):
         """Query user idle times (I command)"""
-        return await self.send_command('I')
+        return await self._cached('I')
 
     async def who_other_room(self, room_name: str):
         """Who is in another room (W command)"""
-        self.process.stdin.write(f'W{room_name}\n')
-        await self.process.stdin.drain()
-        await asyncio.sleep(0.5)
-        return await self._read_output()
+        return await self._exchange(b'W' + room_name.encode() + b'\n')
 
     async def quit(self):
         """Quit COM (q command)"""
         if self.process:
-            await self.send_command('q', wait_for_output=False)
+            for task in list(self._refreshing.values()):
+                task.cancel()
+            async with self._lock:
+                await self._write(self._B_QUIT)
             self.process.close()
             await self.process.wait()
+            if self._reader_task:
+                self._reader_task.cancel()
+                self._reader_task = None
             self.process = None
 
     async def disconnect(self):
-        """Close SSH connection"""
+        """Close SSH connection once no other client is using it"""
+        for session in self.sessions:
+            await session.disconnect()
+        self.sessions = []
         if self.process:
             await self.quit()
+        if self.conn and self._borrowed_conn:
+            self.conn = None
         if self.conn:
+            key = self._conn_key_used
+            if _SHARED_CONN.get(key) is self.conn:
+                _SHARED_USERS[key] -= 1
+                if _SHARED_USERS[key] > 0:
+                    self.conn = None
+                    return
+                del _SHARED_CONN[key], _SHARED_USERS[key]
             self.conn.close()
             await self.conn.wait_closed()
             self.conn = None
 
 
+# Interactive '/x arg' commands (besides /q): name -> coroutine of (client, arg)
+COMMANDS = {
+    'w': lambda c, a: c.get_user_list(),
+    'l': lambda c, a: c.get_room_list(),
+    'g': lambda c, a: c.goto_room(a.strip()),
+    's': lambda c, a: c.say(a),
+    'r': lambda c, a: c.review_history(),
+    'p': lambda c, a: c.peek_room(a.strip()),
+    'h': lambda c, a: c.get_help(),
+    'I': lambda c, a: c.query_idle(),
+    'e': lambda c, a: c.emote(a),
+    'W': lambda c, a: c.who_other_room(a.strip()),
+}
+
+
+def _sample_prompt(welcome: str) -> Optional[Pattern[bytes]]:
+    """Build a prompt pattern from whatever COM left after its last newline
+
+    Returns None when that is blank (COM's usual bare cursor) or looks like
+    text rather than a prompt; responses then end on the idle timeout.
+    """
+    tail = welcome.rpartition('\n')[2].strip()
+    if not tail or len(tail) > 16 or re.search(r'\w', tail):
+        return None
+    return re.compile(rb'(?:^|\n)' + re.escape(tail.encode()) + rb'\s*$')
+
+
+async def _open_stdin() -> Tuple[Optional[asyncio.StreamReader],
+                                  Optional[asyncio.ReadTransport]]:
+    """Attach sys.stdin to the event loop as a stream
+
+    Returns (None, None) when stdin isn't a pipe, socket or tty (e.g. a
+    redirected file), which the event loop can't watch; input is then read
+    with input() in a thread.
+    """
+    mode = os.fstat(sys.stdin.fileno()).st_mode
+    if not (stat.S_ISFIFO(mode) or stat.S_ISSOCK(mode) or sys.stdin.isatty()):
+        return None, None
+    reader = asyncio.StreamReader()
+    loop = asyncio.get_running_loop()
+    # Hand the loop a duplicate, so closing the transport leaves fd 0 open
+    pipe = os.fdopen(os.dup(sys.stdin.fileno()), 'rb', buffering=0)
+    transport, _ = await loop.connect_read_pipe(
+        lambda: asyncio.StreamReaderProtocol(reader), pipe
+    )
+    return reader, transport
+
+
+def _close_stdin(transport: Optional[asyncio.ReadTransport]):
+    """Detach stdin from the event loop and put it back in blocking mode
+
+    The non-blocking flag is shared with the parent shell's terminal.
+    """
+    if transport is None:
+        return
+    transport.close()
+    os.set_blocking(sys.stdin.fileno(), True)
+
+
+async def _ainput(reader: Optional[asyncio.StreamReader],
+                  prompt: str) -> Optional[str]:
+    """Prompt for a line of input without blocking the event loop
+
+    Returns None at end of input.
+    """
+    if reader is None:
+        try:
+            return await asyncio.get_running_loop().run_in_executor(
+                None, input, prompt
+            )
+        except EOFError:
+            return None
+    print(prompt, end='', flush=True)
+    line = await reader.readline()
+    if not line:
+        return None
+    return line.decode(errors='replace').rstrip('\r\n')
+
+
+async def _print_messages(client: SDFComClient):
+    """Print COM chat as it arrives, between command responses"""
+    async for line in client.messages():
+        print(line)
+
+
 async def interactive_session(username: str, password: str):
     """Run an interactive COM session"""
     client = SDFComClient(username, password)
+    stdin_transport = None
+    printer = None
 
     try:
         print(f"Connecting to SDF as {username}...")
@@ -207,60 +720,33 @@ async def interactive_session(username: str, password: str):
 
         print("Starting COM...")
         await client.start_com()
-        print("COM started! Reading initial output...")
-
-        # Read initial COM output
-        await asyncio.sleep(1)
-        output = await client._read_output(timeout=3.0)
-        print(output)
+        print("COM started!")
+        print(client.welcome)
 
         print("\n=== COM Interactive Mode ===")
         print("Commands: /w (who), /l (list rooms), /g <room> (goto), /s <msg> (say)")
         print("          /r (review), /p <room> (peek), /q (quit)")
         print("Or type raw COM commands directly\n")
 
+        stdin, stdin_transport = await _open_stdin()
+        printer = asyncio.create_task(_print_messages(client))
+
         while True:
             try:
-                user_input = await asyncio.get_event_loop().run_in_executor(
-                    None, input, "com> "
-                )
-
-                if user_input.startswith('/q'):
+                user_input = await _ainput(stdin, "com> ")
+                if user_input is None:
                     break
-                elif user_input.startswith('/w'):
-                    output = await client.get_user_list()
-                    print(output)
-                elif user_input.startswith('/l'):
-                    output = await client.get_room_list()
-                    print(output)
-                elif user_input.startswith('/g '):
-                    room = user_input[3:].strip()
-                    output = await client.goto_room(room)
-                    print(output)
-                elif user_input.startswith('/s '):
-                    msg = user_input[3:]
-                    output = await client.say(msg)
-                    print(output)
-                elif user_input.startswith('/r'):
-                    output = await client.review_history()
-                    print(output)
-                elif user_input.startswith('/p '):
-                    room = user_input[3:].strip()
-                    output = await client.peek_room(room)
-                    print(output)
-                elif user_input.startswith('/h'):
-                    output = await client.get_help()
-                    print(output)
-                elif user_input.startswith('/I'):
-                    output = await client.query_idle()
-                    print(output)
-                elif user_input.startswith('/e '):
-                    action = user_input[3:]
-                    output = await client.emote(action)
-                    print(output)
-                elif user_input.startswith('/W '):
-                    room = user_input[3:].strip()
-                    output = await client.who_other_room(room)
+
+                if user_input.startswith('/'):
+                    cmd, _, arg = user_input[1:].partition(' ')
+                    if cmd == 'q':
+                        break
+                    handler = COMMANDS.get(cmd)
+                else:
+                    handler = None
+
+                if handler:
+                    output = await handler(client, arg)
                     print(output)
                 else:
                     # Send raw command to COM
@@ -274,11 +760,29 @@ async def interactive_session(username: str, password: str):
                 print(f"Error: {e}")
 
     finally:
+        if printer is not None:
+            printer.cancel()
+            try:
+                await printer
+            except asyncio.CancelledError:
+                pass
+        _close_stdin(stdin_transport)
         print("\nDisconnecting...")
         await client.disconnect()
         print("Disconnected!")
 
 
+def _run(coro):
+    """asyncio.run(), on uvloop's libuv event loop when it is installed"""
+    try:
+        import uvloop
+    except ImportError:
+        return asyncio.run(coro)
+    # asyncio.Runner rather than uvloop.run(), which needs uvloop 0.18+
+    with asyncio.Runner(loop_factory=uvloop.new_event_loop) as runner:
+        return runner.run(coro)
+
+
 def main():
     parser = argparse.ArgumentParser(description='SDF COM Client')
     parser.add_argument('username', help='SDF username')
@@ -289,12 +793,15 @@ def main():
 
     args = parser.parse_args()
 
-    if args.command or args.room or args.message:
+    if args.command and not (args.room or args.message):
+        # Just one command: skip the full client
+        _run(run_oneshot(args.username, args.password, args.command))
+    elif args.command or args.room or args.message:
         # Single command mode
-        asyncio.run(run_single_command(args))
+        _run(run_single_command(args))
     else:
         # Interactive mode
-        asyncio.run(interactive_session(args.username, args.password))
+        _run(interactive_session(args.username, args.password))
 
 
 async def run_single_command(args):
@@ -304,22 +811,83 @@ async def run_single_command(args):
     try:
         await client.connect()
         await client.start_com()
-        await asyncio.sleep(1)
-
-        # Read initial output
-        await client._read_output(timeout=2.0)
 
+        # Queue everything in one write so the waits overlap, and read until
+        # the last response is complete when its end can be recognised
+        inputs = []
+        done = None
         if args.room:
-            output = await client.goto_room(args.room)
-            print(output)
-
+            inputs.append(SDFComClient._B_GOTO + args.room.encode() + b'\n')
+            done = ROOM_ENTERED
         if args.message:
-            output = await client.say(args.message)
-            print(output)
-
+            inputs.append(b' ' + args.message.encode() + b'\n')
+            done = None
         if args.command:
-            output = await client.send_command(args.command)
-            print(output)
+            inputs.append(args.command.encode() + b'\n')
+            done = RESPONSE_END.get(args.command)
+
+        output = await client.pipeline(*inputs, done=done)
+        print(output)
+
+    finally:
+        await client.disconnect()
+
+
+async def _read_until(process, pattern: Optional[Pattern[bytes]],
+                      timeout: float, idle: float = 0.3) -> str:
+    """Read process output until pattern matches, or until output has been
+    quiet for idle seconds or timeout seconds have passed"""
+    loop = asyncio.get_running_loop()
+    task = asyncio.current_task()
+    buf = bytearray()
+    # The timer interrupts the pending read by cancelling this task
+    timer = _ReadTimer(loop, loop.time() + timeout, idle, task.cancel)
+    try:
+        while pattern is None or not pattern.search(buf):
+            chunk = await process.stdout.read(READ_SIZE)
+            if not chunk:
+                break
+            buf.extend(chunk)
+            timer.data()
+    except asyncio.CancelledError:
+        if not timer.expired:
+            raise
+        task.uncancel()
+    finally:
+        timer.cancel()
+    return buf.decode('utf-8', 'replace')
+
+
+async def run_oneshot(username: str, password: str, command: str,
+                      host: str = "sdf.org"):
+    """Run one COM command, print its output and exit
+
+    Talks to the COM channel directly, without the client's background
+    reader, caching or interactive setup.
+    """
+    client = SDFComClient(username, password, host)
+    conn = await client.connect()
+
+    try:
+        process = await conn.create_process(
+            'com',
+            term_type='xterm-256color',
+            encoding=None
+        )
+
+        # Welcome screen, which also shows whether COM has a prompt
+        welcome = await _read_until(process, PROMPT, timeout=3.0)
+        prompt = _sample_prompt(welcome)
+
+        process.stdin.write(command.encode() + b'\n')
+        output = await _read_until(
+            process, RESPONSE_END.get(command, prompt), timeout=2.0
+        )
+        print(output)
+
+        process.stdin.write(SDFComClient._B_QUIT)
+        process.close()
+        await process.wait()
 
     finally:
         await client.disconnect()